@@ -1,18 +1,32 @@
 import os
 import logging
 import asyncio
+import hmac
+import random
+import re
+import sqlite3
 import sys
-import subprocess
-import google.generativeai as genai
-from telegram import Update
+import time
+import weakref
+from collections import Counter
+from hashlib import blake2b
+from typing import NamedTuple, Optional
+from cachetools import LRUCache, TTLCache
+from telegram import Bot, Update
+from telegram.constants import ChatAction
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler,
+    CommandHandler, MessageHandler,
     filters, ContextTypes, ConversationHandler
 )
-from telegram.error import Forbidden, BadRequest, RetryAfter, TelegramError
+from telegram.error import Forbidden, BadRequest, InvalidToken, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 # local DB helpers
-from db import save_clone, list_all_user_ids, list_active_clones, get_clone, increment_referral, get_referral, upsert_user, REFERRAL_THRESHOLD
+from db import save_clone, deactivate_clone, list_user_ids_after, list_active_clone_ids, get_clone, get_clone_by_token, increment_referral, get_referral, upsert_user, REFERRAL_THRESHOLD
+from db import get_instructions, save_instructions, delete_instructions, list_recent_instructions
+from db import ensure_referral_row, record_referral_join, derive_key
+from bot_core import application_builder, outbound_request, install_uvloop, configure_gemini, reply_streaming, is_quota_error, prompt_too_long, GEMINI_MAX_ATTEMPTS
+from clone_worker import build_clone_application, forget_chat_state, GEMINI_API_KEYS as CLONE_GEMINI_API_KEYS
 
 # Logging
 logging.basicConfig(
@@ -21,7 +35,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Keep your GEMINI key rotation & configure_gemini() code here...
+# Gemini API keys for the master bot; clones run in this process, so their keys join the same pool
 GEMINI_API_KEYS = [key for key in [
     os.getenv("GEMINI_API_KEY_1"),
     os.getenv("GEMINI_API_KEY_2"),
@@ -31,44 +45,199 @@ GEMINI_API_KEYS = [key for key in [
 if not GEMINI_API_KEYS:
     raise ValueError("No Gemini API keys found in environment variables")
 
-current_key_index = 0
-model = None
-
-def configure_gemini():
-    global model, current_key_index
-    try:
-        genai.configure(api_key=GEMINI_API_KEYS[current_key_index])
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        logger.info(f"Successfully configured Gemini with key #{current_key_index + 1}")
-    except Exception as e:
-        logger.error(f"Failed to configure Gemini: {e}")
-        if len(GEMINI_API_KEYS) > 1:
-            current_key_index = (current_key_index + 1) % len(GEMINI_API_KEYS)
-            configure_gemini()
-        else:
-            raise
-
-configure_gemini()
+if not configure_gemini(GEMINI_API_KEYS + CLONE_GEMINI_API_KEYS):
+    raise RuntimeError("Could not configure Gemini with any of the provided API keys")
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_TOKEN environment variable is required")
 
+# Optional: with a public https base URL (e.g. when run as a web process) the master receives updates
+# by webhook on PORT instead of long polling. The path and secret are derived from the token so
+# neither the token nor a guessable URL is exposed.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = blake2b(TELEGRAM_TOKEN.encode(), digest_size=16, person=b"webhook-path").hexdigest()
+WEBHOOK_SECRET = blake2b(TELEGRAM_TOKEN.encode(), digest_size=32, person=b"webhook-secret").hexdigest()
+
 ASK_TOKEN, ASK_INSTRUCTIONS = range(2)
 
-# in-memory caches still used for quick lookups (optional)
+# user_id -> {"task": supervisor task, "stop": asyncio.Event} for every clone hosted in this process
 cloned_apps = {}
-user_instructions = {}
-user_referrals = {}
-referral_codes = {}
-referral_users = {}
+# user_ids with an active clone; loaded at startup and updated when /clone succeeds, so
+# membership checks never hit the DB
+active_clone_ids = frozenset()
+# Bounded write-through cache of per-user instructions; evicted users fault back in from the DB.
+# Texts are interned, so users sharing boilerplate instructions share one string object.
+USER_INSTRUCTIONS_CACHE_SIZE = 10_000
+user_instructions = LRUCache(maxsize=USER_INSTRUCTIONS_CACHE_SIZE)
+# Read-through cache of referral state; refreshed from every DB write
+user_referrals = LRUCache(maxsize=USER_INSTRUCTIONS_CACHE_SIZE)
+
+class ReferralState(NamedTuple):
+    # a tuple per cached user instead of a dict: smaller, and no per-access key hashing
+    count: int
+    verified: bool
+
+NO_REFERRALS = ReferralState(0, False)
+
+def referral_state_from_row(row) -> Optional[ReferralState]:
+    return ReferralState(row["count"], row["verified"]) if row else None
+
+# SQLite calls run in a worker thread so a locked database never stalls the event loop
+async def get_user_instructions(user_id: int) -> str:
+    instructions = user_instructions.get(user_id)
+    if instructions is None:
+        instructions = sys.intern(await asyncio.to_thread(get_instructions, user_id) or "")
+        user_instructions[user_id] = instructions
+    return instructions
+
+async def remember_user_instructions(user_id: int, instructions: str):
+    await asyncio.to_thread(save_instructions, user_id, instructions)
+    user_instructions[user_id] = sys.intern(instructions)
+
+async def forget_user_instructions(user_id: int):
+    await asyncio.to_thread(delete_instructions, user_id)
+    user_instructions.pop(user_id, None)
+
+async def warm_user_instructions():
+    rows = await asyncio.to_thread(list_recent_instructions, USER_INSTRUCTIONS_CACHE_SIZE)
+    for row in rows:
+        user_instructions[row["user_id"]] = sys.intern(row["instructions"])
+    logger.info("Pre-warmed instructions cache with %d users", len(rows))
+
+# Fire-and-forget notifications (e.g. to referrers) go through one background sender so the
+# handler that triggered them doesn't wait on Telegram. Pacing is left to AIORateLimiter.
+NOTIFY_MAX_CHARS = 4096
+notify_queue = asyncio.Queue()
+notify_task = None
+
+def notify(chat_id: int, text: str):
+    notify_queue.put_nowait((chat_id, text))
+
+async def notification_worker(bot: Bot):
+    while True:
+        batch = [await notify_queue.get()]
+        while not notify_queue.empty():
+            batch.append(notify_queue.get_nowait())
+        # merge what is queued for the same chat into as few messages as Telegram's size limit allows
+        merged = {}
+        for chat_id, text in batch:
+            chunks = merged.setdefault(chat_id, [])
+            if chunks and len(chunks[-1]) + 2 + len(text) <= NOTIFY_MAX_CHARS:
+                chunks[-1] += "\n\n" + text
+            else:
+                chunks.append(text)
+        for chat_id, chunks in merged.items():
+            for chunk in chunks:
+                try:
+                    await bot.send_message(chat_id, chunk)
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after + 1)
+                    notify(chat_id, chunk)
+                except Exception as e:
+                    logger.error("Could not notify %s: %s", chat_id, e)
+
+# Referral codes are ref_<user_id>_<hmac>: verified by recomputing the signature, nothing is stored.
+# Without REFERRAL_SECRET the key is a subkey derived from MASTER_KEY, never the token key itself.
+REFERRAL_SECRET = os.getenv("REFERRAL_SECRET", "").encode() or derive_key(b"referral-codes")
+REFERRAL_SIG_CHARS = 12
+REFERRAL_CODE_RE = re.compile(r"ref_(\d+)_([0-9a-f]+)")
+
+def referral_signature(user_id: int) -> str:
+    return hmac.new(REFERRAL_SECRET, str(user_id).encode(), "sha256").hexdigest()[:REFERRAL_SIG_CHARS]
+
+def referral_code_for(user_id: int) -> str:
+    return f"ref_{user_id}_{referral_signature(user_id)}"
+
+def referral_code_owner(match: re.Match) -> Optional[int]:
+    """user_id a REFERRAL_CODE_RE match was signed for, or None if the code is forged."""
+    user_id = int(match.group(1))
+    return user_id if hmac.compare_digest(match.group(2), referral_signature(user_id)) else None
+
+async def get_referral_state(user_id: int) -> Optional[ReferralState]:
+    """Cached referral row for user_id, or None if the user has never been part of the referral program."""
+    if user_id in user_referrals:
+        return user_referrals[user_id]
+    state = referral_state_from_row(await asyncio.to_thread(get_referral, user_id))
+    user_referrals[user_id] = state
+    return state
+
+async def add_referral(referrer_id: int) -> ReferralState:
+    state = referral_state_from_row(await asyncio.to_thread(increment_referral, referrer_id))
+    user_referrals[referrer_id] = state
+    # the referrer's clone shows progress in its watermark
+    forget_chat_state(referrer_id)
+    return state
+
+async def enroll_referrer(user_id: int):
+    await asyncio.to_thread(ensure_referral_row, user_id)
+    user_referrals.pop(user_id, None)
+
+# Reply texts. Fixed ones are plain constants; the rest are filled with one str.format call per reply.
+START_TEXT = (
+    "🤖 Hello! I'm your AI bot (GPT-powered). Send me a message!\n\n"
+    "Use /clone to create your own AI bot with your own custom instructions!"
+)
+START_PENDING_SHARE_TEMPLATE = (
+    "📣 Share with {remaining} more people to remove the watermark!\n\n"
+    "Use /share to get your referral link and instructions."
+)
+WELCOME_REFERRED_TEXT = "👋 Welcome! You joined through a friend's referral.\n\nUse /clone to create your own AI bot or just start chatting! 🚀"
+WELCOME_TEXT = "🤖 Hello! Welcome to the DAX AI bot experience!\n\nUse /clone to create your own AI assistant with custom instructions!"
+REFERRAL_UNLOCKED_TEXT = "✨ Premium Experience Unlocked! ✨\n\n🎊 Thank you for sharing!\n✅ The watermark has been removed from your bot."
+REFERRAL_JOINED_TEMPLATE = "🎉 @{username} joined using your referral link!\n📊 You now have {count} referrals. {remaining} more to remove the watermark."
+SHARE_NEEDS_CLONE_TEXT = "⚠️ You need to create your own bot first using /clone to use the referral system!👀"
+SHARE_TEMPLATE = (
+    "📣 Referral Program\n\n"
+    "🔗 Your unique link: https://t.me/{bot_username}?start={code}\n\n"
+    "📊 Progress: {count}/{threshold} referrals\n"
+    "🎯 Remaining: {remaining} more to remove watermark\n\n"
+    "How it works:\n"
+    "• Share your unique link with friends\n"
+    "• When they join using your link, it counts\n"
+    "• After {threshold} real joins, watermark disappears\n\n"
+    "✨ No fake clicks - only real joins count!"
+)
+INSTRUCTIONS_SET_TEMPLATE = (
+    "✅ Custom instructions set! Your AI will now follow these guidelines:\n\n"
+    "⚡{instructions}⚡\n\n"
+    "Use /clear_instructions to remove them."
+)
+INSTRUCTIONS_CURRENT_TEMPLATE = (
+    "📝 Your current instructions:\n\n"
+    "{instructions}\n\n"
+    "To change: /set_instructions [your new instructions]"
+)
+INSTRUCTIONS_NONE_TEXT = (
+    "You haven't set any custom instructions yet.👀\n\n"
+    "Example: /set_instructions You are a helpful assistant who is irresistible to DEATH"
+)
+TOKEN_ALREADY_CLONED_TEXT = "❌ That bot is already cloned from another account."
+CLONE_INTRO_TEXT = (
+    "🚀 Let's create your AI bot!\n\n"
+    "1. First, send me your Telegram bot token (from @BotFather)\n"
+    "2. Then, I'll ask for your custom instructions\n\n"
+    "Send your bot token now or /cancel to abort."
+)
+CLONE_TOKEN_REVOKED_TEXT = (
+    "⚠️ Your cloned bot was stopped because its token was revoked in @BotFather.\n\n"
+    "Use /clone with a new token to bring it back."
+)
+CLONE_LIVE_TEMPLATE = (
+    "🎉 Your AI bot @{bot_username} is now live!\n\n"
+    "📝 Instructions: _{instructions}_\n\n"
+    "⚠️ Your bot will have a watermark until you share with {threshold} friends.\n"
+    "Use /share to get your referral link and remove the watermark!"
+)
 
 # Start command (same as before)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
 
-    upsert_user(
+    await asyncio.to_thread(
+        upsert_user,
         user_id=user_id,
         username=user.username or "",
         first_name=user.first_name or "",
@@ -76,153 +245,181 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     username = user.username or f"user_{user_id}"
-    if context.args and context.args[0].startswith('ref_'):
-        referral_code = context.args[0]
-        await handle_referral(update, context, referral_code, user_id, username)
+    referral = REFERRAL_CODE_RE.fullmatch(context.args[0]) if context.args else None
+    if referral:
+        await handle_referral(update, context, referral, user_id, username)
         return
-    if user_id in user_referrals and not user_referrals[user_id]['verified']:
-        remaining = 5 - user_referrals[user_id]['count']
-        await update.message.reply_text(
-            f"📣 Share with {remaining} more people to remove the watermark!\n\n"
-            "Use /share to get your referral link and instructions."
-        )
+    ref_row = await get_referral_state(user_id)
+    if ref_row and not ref_row.verified:
+        remaining = max(0, REFERRAL_THRESHOLD - ref_row.count)
+        await update.message.reply_text(START_PENDING_SHARE_TEMPLATE.format(remaining=remaining))
         return
-    await update.message.reply_text(
-        "🤖 Hello! I'm your AI bot (GPT-powered). Send me a message!\n\n"
-        "Use /clone to create your own AI bot with your own custom instructions!"
-)
+    await update.message.reply_text(START_TEXT)
 
-async def handle_referral(update: Update, context: ContextTypes.DEFAULT_TYPE, referral_code: str, new_user_id: int, new_username: str):
-    if referral_code in referral_codes:
-        referrer_id = referral_codes[referral_code]
-        # Avoid counting the same join multiple times; track in referral_users (in-memory)
-        if new_user_id not in referral_users:
-            referral_users[new_user_id] = referrer_id
-            # Persist increment and get updated row
+async def handle_referral(update: Update, context: ContextTypes.DEFAULT_TYPE, referral: re.Match, new_user_id: int, new_username: str):
+    referrer_id = referral_code_owner(referral)
+    if referrer_id is not None:
+        # Each user can only ever be counted once, across restarts (persisted in referral_joins)
+        if referrer_id != new_user_id and await asyncio.to_thread(record_referral_join, new_user_id, referrer_id):
             try:
-                ref_row = increment_referral(referrer_id)
+                ref_row = await add_referral(referrer_id)
             except Exception as e:
-                logger.error(f"Failed to increment persisted referral for {referrer_id}: {e}")
-                ref_row = get_referral(referrer_id) or {"count": 0, "verified": False}
+                logger.error("Failed to increment persisted referral for %s: %s", referrer_id, e)
+                ref_row = await get_referral_state(referrer_id) or NO_REFERRALS
 
-            # Update in-memory copy for quick messaging and compatibility
-            if referrer_id not in user_referrals:
-                user_referrals[referrer_id] = {'count': ref_row.get("count", 0), 'verified': ref_row.get("verified", False)}
+            remaining = max(0, REFERRAL_THRESHOLD - ref_row.count)
+            # increment_referral flips verified itself, so the unlock is the join that hit the threshold
+            if ref_row.verified and ref_row.count == REFERRAL_THRESHOLD:
+                notify(referrer_id, REFERRAL_UNLOCKED_TEXT)
             else:
-                user_referrals[referrer_id]['count'] = ref_row.get("count", 0)
-                user_referrals[referrer_id]['verified'] = ref_row.get("verified", False)
-
-            try:
-                remaining = max(0, REFERRAL_THRESHOLD - ref_row.get("count", 0))
-                if not ref_row.get("verified", False) and ref_row.get("count", 0) >= REFERRAL_THRESHOLD:
-                    user_referrals[referrer_id]['verified'] = True
-                    await context.bot.send_message(
-                        referrer_id,
-                        "✨ Premium Experience Unlocked! ✨\n\n🎊 Thank you for sharing!\n✅ The watermark has been removed from your bot."
-                    )
-                else:
-                    await context.bot.send_message(
-                        referrer_id,
-                        f"🎉 @{new_username} joined using your referral link!\n📊 You now have {ref_row.get('count',0)} referrals. {remaining} more to remove the watermark."
-                    )
-            except Exception as e:
-                logger.error(f"Could not notify referrer {referrer_id}: {e}")
+                notify(referrer_id, REFERRAL_JOINED_TEMPLATE.format(
+                    username=new_username, count=ref_row.count, remaining=remaining
+                ))
 
-        await update.message.reply_text(
-            f"👋 Welcome! You joined through a friend's referral.\n\nUse /clone to create your own AI bot or just start chatting! 🚀"
-        )
+        await update.message.reply_text(WELCOME_REFERRED_TEXT)
     else:
         # default greeting when no valid referral
-        await update.message.reply_text(
-            "🤖 Hello! Welcome to the DAX AI bot experience!\n\nUse /clone to create your own AI assistant with custom instructions!"
-)
+        await update.message.reply_text(WELCOME_TEXT)
 
 async def share_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or f"user_{user_id}"
-    if user_id not in cloned_apps and user_id not in [c['user_id'] for c in list_active_clones()]:
-        await update.message.reply_text(
-            "⚠️ You need to create your own bot first using /clone to use the referral system!👀"
-        )
+    if user_id not in cloned_apps and user_id not in active_clone_ids:
+        await update.message.reply_text(SHARE_NEEDS_CLONE_TEXT)
         return
-    referral_code = f"ref_{user_id}_{os.urandom(4).hex()}"
-    referral_codes[referral_code] = user_id
-    if user_id not in user_referrals:
-        user_referrals[user_id] = {'count': 0, 'verified': False}
-    master_username = (await context.bot.get_me()).username
-    referral_link = f"https://t.me/{master_username}?start={referral_code}"
-    remaining = 5 - user_referrals[user_id]['count']
-    await update.message.reply_text(
-        f"📣 Referral Program\n\n"
-        f"🔗 Your unique link: {referral_link}\n\n"
-        f"📊 Progress: {user_referrals[user_id]['count']}/5 referrals\n"
-        f"🎯 Remaining: {remaining} more to remove watermark\n\n"
-        "How it works:\n"
-        "• Share your unique link with friends\n"
-        "• When they join using your link, it counts\n"
-        "• After 5 real joins, watermark disappears\n\n"
-        "✨ No fake clicks - only real joins count!"
-    )
-
-# Chat handler (uses model) - kept simple; use asyncio.to_thread if model is blocking
+    referral_code = referral_code_for(user_id)
+    ref_row = await get_referral_state(user_id) or NO_REFERRALS
+    await update.message.reply_text(SHARE_TEMPLATE.format(
+        bot_username=context.application.bot_data["master_username"],
+        code=referral_code,
+        count=ref_row.count,
+        threshold=REFERRAL_THRESHOLD,
+        remaining=max(0, REFERRAL_THRESHOLD - ref_row.count),
+    ))
+
+# Messages a user sends to one chat within this window are merged into a single Gemini prompt
+CHAT_COALESCE_WINDOW = 0.2
+# (chat_id, user_id) -> messages waiting for the in-flight handler of that user in that chat. Keyed
+# by chat too, so a group message is never merged into (or answered in) the user's private chat.
+pending_messages = {}
+# (chat_id, user_id) -> lock held while that user's reply in that chat is generated: one Gemini call
+# per user and chat at a time, so replies stay in order. Weak values drop a lock once no handler
+# holds or waits on it.
+user_reply_locks = weakref.WeakValueDictionary()
+
+# Chat handler (uses Gemini) - streams from the SDK's async client so the event loop stays free
 async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Master bot: respond without appending any watermark.
-    if model is None:
-        await update.message.reply_text("⚠️ Bot is not properly configured. Please contact the administrator.")
-        return
-
-    user_message = update.message.text or ""
     user_id = update.effective_user.id
+    key = (update.effective_chat.id, user_id)
 
+    # Relies on concurrent_updates: the first message of a burst waits briefly, later ones just join it
+    batch = pending_messages.get(key)
+    if batch is not None:
+        batch.append(update.message)
+        return
+    pending_messages[key] = batch = [update.message]
     try:
-        # Use per-user instructions if present
-        instructions = user_instructions.get(user_id, "")
-        prompt = f"{instructions}\n\nUser: {user_message}" if instructions else user_message
-
-        # Call model off the event loop if blocking
-        resp = await asyncio.to_thread(model.generate_content, prompt)
-        response_text = getattr(resp, "text", str(resp))
+        await asyncio.sleep(CHAT_COALESCE_WINDOW)
+    finally:
+        del pending_messages[key]
+    user_message = "\n".join(m.text or "" for m in batch)
+    message = batch[-1]
+    # show "typing..." right away without making the reply wait on that call
+    context.application.create_task(message.chat.send_action(ChatAction.TYPING))
+
+    lock = user_reply_locks.get(key)
+    if lock is None:
+        user_reply_locks[key] = lock = asyncio.Lock()
+    async with lock:
+        await answer_chat(message, user_id, user_message)
+
+async def answer_chat(message, user_id: int, user_message: str):
+    try:
+        # Per-user instructions travel as Gemini's system instruction, not as a prompt prefix
+        instructions = await get_user_instructions(user_id)
+        if prompt_too_long(user_message, instructions):
+            await message.reply_text("⚠️ Your message is too long. Please send a shorter one.")
+            return
 
-        # NOTE: No watermark appended here — watermark is handled only by clone workers.
-        await update.message.reply_text(response_text)
+        # Streamed: the reply appears after the first chunk and is edited as the rest arrives.
+        # NOTE: No watermark appended here — watermark is handled only by clone bots.
+        await reply_streaming(message, user_message, instructions)
 
     except Exception as e:
-        if "429" in str(e) or "quota" in str(e).lower():
-            switch_key()
-            await update.message.reply_text("⚠️ Quota exceeded, switching API key... Please try again.")
+        if is_quota_error(e):
+            logger.warning("Gemini quota still exceeded after %d attempts: %s", GEMINI_MAX_ATTEMPTS, e)
+            await message.reply_text("⚠️ I'm receiving too many requests right now. Please try again in a moment.")
         else:
-            logger.error(f"Error in master chat handler: {e}")
-            await update.message.reply_text("⚠️ Sorry, I encountered an error processing your request.")
-            
-def switch_key():
-    global current_key_index
-    current_key_index = (current_key_index + 1) % len(GEMINI_API_KEYS)
-    configure_gemini()
-    logger.warning(f"Switched to API key #{current_key_index + 1}")
+            logger.error("Error in master chat handler: %s", e)
+            await message.reply_text("⚠️ Sorry, I encountered an error processing your request.")
 
 async def set_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if context.args:
         instructions = " ".join(context.args)
-        user_instructions[user_id] = instructions
-        await update.message.reply_text(
-            "✅ Custom instructions set! Your AI will now follow these guidelines:\n\n"
-            f"⚡{instructions}⚡\n\n"
-            "Use /clear_instructions to remove them."
-        )
+        await remember_user_instructions(user_id, instructions)
+        await update.message.reply_text(INSTRUCTIONS_SET_TEMPLATE.format(instructions=instructions))
     else:
-        current = user_instructions.get(user_id)
+        current = await get_user_instructions(user_id)
         if current:
-            await update.message.reply_text(
-                "📝 Your current instructions:\n\n"
-                f"{current}\n\n"
-                "To change: /set_instructions [your new instructions]"
-            )
+            await update.message.reply_text(INSTRUCTIONS_CURRENT_TEMPLATE.format(instructions=current))
         else:
-            await update.message.reply_text(
-                "You haven't set any custom instructions yet.👀\n\n"
-                "Example: /set_instructions You are a helpful assistant who is irresistible to DEATH"
-            )
+            await update.message.reply_text(INSTRUCTIONS_NONE_TEXT)
+
+# Broadcast fan-out: this many concurrent senders; pacing to Telegram's 30 msg/s is done by AIORateLimiter
+BROADCAST_WORKERS = 30
+BROADCAST_MAX_RETRIES = 3
+# the producer stays at most this far ahead of the workers
+BROADCAST_QUEUE_SIZE = 1000
+
+async def iter_user_ids(batch: int = BROADCAST_QUEUE_SIZE):
+    """Every user id, fetched one page at a time so the whole table is never held in memory."""
+    after = -1
+    while True:
+        page = await asyncio.to_thread(list_user_ids_after, after, batch)
+        for uid in page:
+            yield uid
+        if len(page) < batch:
+            return
+        after = page[-1]
+
+async def broadcast_worker(bot: Bot, queue: asyncio.Queue, text: str, stats: Counter, attempts: Counter, retries: set):
+    while True:
+        uid = await queue.get()
+        requeued = False
+        try:
+            await bot.send_message(uid, text)
+            stats["sent"] += 1
+        except RetryAfter as e:
+            attempts[uid] += 1
+            if attempts[uid] > BROADCAST_MAX_RETRIES:
+                stats["failed"] += 1
+            else:
+                # requeue after the flood wait instead of sleeping, so this worker keeps sending;
+                # task_done() is deferred to the requeue so queue.join() still waits for the user
+                delay = max(e.retry_after + 1, 2 ** attempts[uid])
+                task = asyncio.create_task(requeue_later(queue, uid, delay))
+                retries.add(task)
+                task.add_done_callback(retries.discard)
+                requeued = True
+        except (Forbidden, BadRequest):
+            stats["failed"] += 1  # user blocked bot or invalid
+        except TelegramError:
+            stats["failed"] += 1
+        except Exception as e:
+            # e.g. a timeout from the shared pool: count it and keep the worker alive
+            logger.warning("Broadcast to %s failed: %s", uid, e)
+            stats["failed"] += 1
+        finally:
+            # every dequeued user is marked done exactly once, or queue.join() in /broadcast never returns
+            if not requeued:
+                queue.task_done()
+
+async def requeue_later(queue: asyncio.Queue, uid: int, delay: float):
+    await asyncio.sleep(delay)
+    await queue.put(uid)
+    queue.task_done()
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if the sender is allowed (e.g., your own ID or a list of admins)
@@ -236,106 +433,217 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text_to_send = " ".join(context.args)
-    sent, failed = 0, 0
-
-    for uid in list_all_user_ids():
-        try:
-            await context.bot.send_message(uid, text_to_send)
-            sent += 1
-            await asyncio.sleep(0.05)  # small delay to avoid hitting Telegram rate limits
-        except (Forbidden, BadRequest):
-            failed += 1  # user blocked bot or invalid
-        except RetryAfter as e:
-            await asyncio.sleep(e.retry_after + 1)
-            continue
-        except TelegramError:
-            failed += 1
+    queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+    # only touched from this event loop, so no locking
+    stats = Counter()
+    attempts = Counter()
+    retries = set()
+    workers = [
+        asyncio.create_task(broadcast_worker(context.bot, queue, text_to_send, stats, attempts, retries))
+        for _ in range(BROADCAST_WORKERS)
+    ]
+    try:
+        # sending starts with the first queued id; memory stays at O(queue size + workers)
+        async for uid in iter_user_ids():
+            await queue.put(uid)
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
 
-    await update.message.reply_text(f"✅ Broadcast finished: {sent} sent, {failed} failed.")
+    await update.message.reply_text(f"✅ Broadcast finished: {stats['sent']} sent, {stats['failed']} failed.")
 
 async def clear_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id in user_instructions:
-        del user_instructions[user_id]
+    if await get_user_instructions(user_id):
+        await forget_user_instructions(user_id)
         await update.message.reply_text("✅ Custom instructions successfully erased!")
     else:
         await update.message.reply_text("You don't have any custom instructions set.🥲")
 
-# Conversation for /clone remains but now we persist and spawn a worker instead of in-process start
+# Conversation for /clone: the clone is persisted, then hosted in this process by start_clone
 async def clone(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "🚀 Let's create your AI bot!\n\n"
-        "1. First, send me your Telegram bot token (from @BotFather)\n"
-        "2. Then, I'll ask for your custom instructions\n\n"
-        "Send your bot token now or /cancel to abort."
-    )
+    await update.message.reply_text(CLONE_INTRO_TEXT)
     return ASK_TOKEN
 
+TOKEN_PROBE_TIMEOUT = 10
+# Successful probes are remembered for a few minutes so a user re-running /clone with the
+# same token skips the round-trip; keyed by a short token hash so plaintext tokens aren't kept as keys
+probed_tokens = TTLCache(maxsize=128, ttl=300)
+
+async def probe_token(token: str, request: HTTPXRequest):
+    """getMe for token over an already-open request pool (typically the master bot's own)."""
+    key = blake2b(token.encode(), digest_size=8).hexdigest()
+    me = probed_tokens.get(key)
+    if me is not None:
+        return me
+    # No initialize()/shutdown(): the pool belongs to the caller and must stay open, and get_me()
+    # doesn't need an initialized Bot. The warm HTTP/2 connection saves a TCP+TLS handshake per /clone.
+    # get_updates_request too, or Bot would build (and never close) a default pool for it per probe.
+    me = await Bot(token=token, request=request, get_updates_request=request).get_me()
+    probed_tokens[key] = me
+    return me
+
 async def receive_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_token = update.message.text.strip()
     context.user_data['clone_token'] = user_token
 
     try:
-        # Validate token by creating a Bot and calling get_me (no polling)
-        from telegram import Bot
-        test_bot = Bot(token=user_token)
-        me = await test_bot.get_me()
+        # Validate token with a bare Bot on the shared connection pool (no Application, no polling)
+        me = await asyncio.wait_for(probe_token(user_token, context.bot.request), timeout=TOKEN_PROBE_TIMEOUT)
+        # two clones polling one token would steal each other's updates
+        existing = await asyncio.to_thread(get_clone_by_token, user_token)
+        if existing and existing["user_id"] != update.effective_user.id:
+            await update.message.reply_text(TOKEN_ALREADY_CLONED_TEXT + " Send a different token or /cancel.")
+            return ASK_TOKEN
         context.user_data['clone_username'] = me.username
         await update.message.reply_text(
             f"✅ Token valid! Your bot @{me.username} will be created.\n\n"
             "Now send me your custom instructions for the AI:"
         )
         return ASK_INSTRUCTIONS
-    except Forbidden:
+    except (Forbidden, InvalidToken):
         await update.message.reply_text("❌ Invalid token. Please send a valid bot token or /cancel.")
         return ASK_TOKEN
+    except asyncio.TimeoutError:
+        logger.warning("Timed out validating a clone token")
+        await update.message.reply_text("❌ Telegram took too long to answer. Please try again or /cancel.")
+        return ASK_TOKEN
     except Exception as e:
-        logger.error(f"Error validating token: {e}")
+        logger.error("Error validating token: %s", e)
         await update.message.reply_text("❌ Error validating token. Please try again or /cancel.")
         return ASK_TOKEN
 
-def spawn_clone_worker(user_id: int):
-    logger = logging.getLogger(__name__)
-    env = os.environ.copy()
-    env["CLONE_USER_ID"] = str(user_id)
-    # DB_PATH and MASTER_KEY must already be present in env
-    if "MASTER_KEY" not in env:
-        logger.error("MASTER_KEY missing when attempting to spawn worker")
-        raise RuntimeError("MASTER_KEY missing")
-    python = sys.executable
-    worker_script = os.path.join(os.path.dirname(__file__), "clone_worker.py")
-    logger.info("Spawning clone worker for user %s with script %s", user_id, worker_script)
-    proc = subprocess.Popen([python, worker_script], env=env, close_fds=True)
-    logger.info("Spawned pid %s for clone %s", proc.pid, user_id)
-    return proc
+# Each clone holds one getUpdates long poll. A long server-side timeout means an idle clone's
+# request returns (and wakes the loop) every 50s instead of every 10s, and clones only ask
+# for the update type their handlers use.
+CLONE_POLL_TIMEOUT = 50
+CLONE_ALLOWED_UPDATES = [Update.MESSAGE]
+# A revoked token only kills the clone's polling loop, so each clone checks its token this often
+CLONE_LIVENESS_INTERVAL = 300
+
+# The master and every hosted clone send through one HTTP/2 pool instead of a pool per bot (each
+# bot still has its own getUpdates connection and rate limiter, since both are per bot token).
+# /clone token probes reuse it too, via context.bot.request.
+SHARED_CONNECTION_POOL_SIZE = 512
+shared_request = outbound_request(SHARED_CONNECTION_POOL_SIZE, shared=True)
+
+async def run_clone_app(user_id: int, stop_event: asyncio.Event) -> bool:
+    """Poll one clone bot inside this event loop until stop_event is set. Returns False if there is nothing to run."""
+    forget_chat_state(user_id)
+    clone_rec = await asyncio.to_thread(get_clone, user_id)
+    if not clone_rec or not clone_rec["active"]:
+        return False
+    app = build_clone_application(user_id, clone_rec["token"], shared_request)
+    await app.initialize()
+    try:
+        await app.start()
+        await app.updater.start_polling(timeout=CLONE_POLL_TIMEOUT, allowed_updates=CLONE_ALLOWED_UPDATES)
+        logger.info("Clone @%s for user %s is polling", clone_rec["bot_username"], user_id)
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=CLONE_LIVENESS_INTERVAL)
+            except asyncio.TimeoutError:
+                await probe_clone_token(app)
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+    return True
+
+async def probe_clone_token(app):
+    """Raise InvalidToken if the clone's token was revoked; other failures are left to the next probe."""
+    try:
+        await app.bot.get_me()
+    except InvalidToken:
+        raise
+    except TelegramError as e:
+        logger.debug("Clone liveness probe failed: %s", e)
+
+# Restart policy for clones that fail to start: min(2**n, 60)s with +/-25% jitter
+CLONE_RESTART_CAP = 60
+
+async def supervise_clone(user_id: int, stop_event: asyncio.Event):
+    """Keep a clone bot running until stop_event is set, restarting it with backoff if it fails."""
+    failures = 0
+    while not stop_event.is_set():
+        started = time.monotonic()
+        try:
+            if not await run_clone_app(user_id, stop_event):
+                logger.warning("No active clone record for %s; not starting", user_id)
+            return
+        except InvalidToken:
+            # the owner revoked the token in @BotFather; retrying cannot help
+            logger.warning("Clone token for %s was rejected; deactivating the clone", user_id)
+            await retire_revoked_clone(user_id, stop_event)
+            return
+        except Exception as e:
+            # a clone that stayed up for a while is healthy again, so start the backoff over
+            failures = 1 if time.monotonic() - started > CLONE_RESTART_CAP else failures + 1
+            delay = min(2 ** failures, CLONE_RESTART_CAP) * random.uniform(0.75, 1.25)
+            logger.error("Clone bot for %s failed: %s; restarting in %.1fs", user_id, e, delay)
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+async def retire_revoked_clone(user_id: int, stop_event: asyncio.Event):
+    # a re-clone may already have replaced this supervisor with one for a new token
+    entry = cloned_apps.get(user_id)
+    if entry is None or entry["stop"] is not stop_event:
+        return
+    del cloned_apps[user_id]
+    mark_clone_inactive(user_id)
+    try:
+        await asyncio.to_thread(deactivate_clone, user_id)
+    except Exception as e:
+        logger.error("Failed to deactivate clone for %s: %s", user_id, e)
+    notify(user_id, CLONE_TOKEN_REVOKED_TEXT)
+
+async def stop_clone(user_id: int):
+    entry = cloned_apps.pop(user_id, None)
+    if entry:
+        entry["stop"].set()
+        await entry["task"]
+
+async def start_clone(user_id: int):
+    # a re-clone replaces the running clone, which may still be polling an old token
+    await stop_clone(user_id)
+    stop_event = asyncio.Event()
+    task = asyncio.create_task(supervise_clone(user_id, stop_event))
+    cloned_apps[user_id] = {"task": task, "stop": stop_event}
 
 async def receive_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     instructions = update.message.text.strip()
     user_token = context.user_data['clone_token']
     bot_username = context.user_data['clone_username']
     user_id = update.effective_user.id
-    user_instructions[user_id] = instructions
     owner_username = update.effective_user.username or (update.effective_user.first_name or f"user_{user_id}")
     
     try:
-        # Persist clone metadata (encrypts token)
-        save_clone(user_id, user_token, bot_username, instructions, owner_username)
+        # Persist clone metadata (encrypts token) before anything reports the clone as live
+        await asyncio.to_thread(save_clone, user_id, user_token, bot_username, instructions, owner_username)
+        mark_clone_active(user_id)
+        await remember_user_instructions(user_id, instructions)
 
-        # Spawn a detached worker process that runs the cloned bot
-        spawn_clone_worker(user_id)
+        # Start the cloned bot in this event loop under a supervisor task
+        await start_clone(user_id)
 
-        # Initialize referral tracking for this user
-        user_referrals[user_id] = {'count': 0, 'verified': False}
+        # Initialize referral tracking for this user (keeps progress from an earlier clone)
+        await enroll_referrer(user_id)
 
-        await update.message.reply_text(
-            f"🎉 Your AI bot @{bot_username} is now live!\n\n"
-            f"📝 Instructions: _{instructions}_\n\n"
-            "⚠️ Your bot will have a watermark until you share with 5 friends.\n"
-            "Use /share to get your referral link and remove the watermark!"
-        )
+        await update.message.reply_text(CLONE_LIVE_TEMPLATE.format(
+            bot_username=bot_username, instructions=instructions, threshold=REFERRAL_THRESHOLD
+        ))
+        return ConversationHandler.END
+    except sqlite3.IntegrityError:
+        # another account's active clone took this token after receive_token checked it
+        await update.message.reply_text(TOKEN_ALREADY_CLONED_TEXT)
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Error starting cloned bot: {e}")
+        logger.error("Error starting cloned bot: %s", e)
         await update.message.reply_text("❌ Failed to start your bot😥. Please try again.")
         return ConversationHandler.END
 
@@ -343,12 +651,59 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Operation cancelled❌.")
     return ConversationHandler.END
 
-async def shutdown_application():
-    logger.info("Shutting down all cloned bots (master manages only spawning).")
-    # master no longer manages in-process clone apps; workers run independently
+async def shutdown_application(app=None):
+    if notify_task:
+        notify_task.cancel()
+    logger.info("Shutting down all cloned bots (%d running).", len(cloned_apps))
+    # stop every clone at once so shutdown takes as long as the slowest one, not the sum of all
+    results = await asyncio.gather(*(stop_clone(uid) for uid in list(cloned_apps)), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Error while stopping a clone: %s", result)
+    # post_shutdown runs after the master's own shutdown, so nothing sends through the pool any more
+    await shared_request.close()
+
+async def post_init(app):
+    global notify_task
+    # the bot's own username never changes; initialize() already fetched it, so /share needs no getMe per call
+    app.bot_data["master_username"] = app.bot.username
+    notify_task = asyncio.create_task(notification_worker(app.bot))
+    try:
+        await warm_user_instructions()
+    except Exception as e:
+        logger.error("Failed to pre-warm instructions cache: %s", e)
+    await respawn_active_clones()
+
+def mark_clone_active(user_id: int):
+    global active_clone_ids
+    active_clone_ids = active_clone_ids | {user_id}
+
+def mark_clone_inactive(user_id: int):
+    global active_clone_ids
+    active_clone_ids = active_clone_ids - {user_id}
+
+async def respawn_active_clones():
+    # On startup, respawn active clones from DB
+    global active_clone_ids
+    try:
+        # ids only: each supervisor loads (and decrypts) its own record when it starts the clone
+        active_clone_ids = await asyncio.to_thread(list_active_clone_ids)
+    except Exception as e:
+        logger.error("Failed to load active clones from DB: %s", e)
+        return
+    for user_id in active_clone_ids:
+        await start_clone(user_id)
 
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # must happen before run_polling() creates the loop
+    install_uvloop()
+    app = (
+        application_builder(TELEGRAM_TOKEN, shared_request)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(shutdown_application)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("set_instructions", set_instructions))
     app.add_handler(CommandHandler("clear_instructions", clear_instructions))
@@ -365,26 +720,19 @@ def main():
     app.add_handler(conv_handler)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat))
 
-    # On startup, respawn active clones from DB
-    try:
-        active = list_active_clones()
-        for clone_rec in active:
-            uid = clone_rec["user_id"]
-            try:
-                spawn_clone_worker(uid)
-            except Exception as e:
-                logging.error(f"Failed to spawn worker for {uid}: {e}")
-    except Exception as e:
-        logging.error(f"Failed to load active clones from DB: {e}")
-
     logger.info("Master bot is running (with persistent clones)...")
-    try:
+    # run_webhook/run_polling install the SIGINT/SIGTERM/SIGABRT handlers themselves and, on the same loop
+    # the clones run on, stop the master and then await post_shutdown (shutdown_application), which stops every clone
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
         app.run_polling()
-    except KeyboardInterrupt:
-        logger.info("Received interrupt signal, shutting down...")
-    finally:
-        # workers are independent; master does not own their lifecycle here.
-        pass
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,431 @@
+"""Helpers shared by the master bot (bot.py) and the clone bots (clone_worker.py)."""
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+import zlib
+from collections import Counter
+from functools import lru_cache
+from hashlib import blake2b
+from typing import List, Optional
+
+from cachetools import TTLCache
+from db import get_cached_response, save_cached_response, prune_cached_responses
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types
+from telegram import LinkPreviewOptions
+from telegram.error import TelegramError
+from telegram.ext import AIORateLimiter, ApplicationBuilder
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Outbound Bot API calls and getUpdates long-polling use separate HTTPX pools so that
+# a burst of send_message calls can never starve polling (or vice versa).
+CONNECTION_POOL_SIZE = 64
+GET_UPDATES_POOL_SIZE = 4
+HTTP_TIMEOUT = 20.0
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """An outbound pool used by several bots. Their shutdown() leaves it open; the owner calls close()."""
+
+    async def shutdown(self):
+        pass
+
+    async def close(self):
+        await super().shutdown()
+
+def outbound_request(pool_size: int = CONNECTION_POOL_SIZE, shared: bool = False) -> HTTPXRequest:
+    # Outbound calls share HTTP/2 connections (stream multiplexing) instead of one socket per in-flight request
+    return (SharedHTTPXRequest if shared else HTTPXRequest)(
+        connection_pool_size=pool_size,
+        pool_timeout=HTTP_TIMEOUT,
+        read_timeout=HTTP_TIMEOUT,
+        write_timeout=HTTP_TIMEOUT,
+        connect_timeout=HTTP_TIMEOUT,
+        http_version="2",
+    )
+
+def application_builder(token: str, request: HTTPXRequest = None) -> ApplicationBuilder:
+    """Return an ApplicationBuilder with explicitly sized connection pools and Telegram's rate limits applied.
+
+    request, if given, is used for outbound calls instead of a pool of the app's own.
+    """
+    if request is None:
+        request = outbound_request()
+    # the long-poll stays on HTTP/1.1 since it only ever has one request open
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=GET_UPDATES_POOL_SIZE,
+        pool_timeout=HTTP_TIMEOUT,
+        http_version="1.1",
+    )
+    # Queue outgoing calls client-side so we stay inside Telegram's 30 msg/s (and 20 msg/min per group) limits
+    rate_limiter = AIORateLimiter(overall_max_rate=30, overall_time_period=1, group_max_rate=20, group_time_period=60)
+    return (
+        ApplicationBuilder()
+        .token(token)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(rate_limiter)
+    )
+
+def install_uvloop():
+    """Run the event loop on uvloop when it is installed (it isn't available on Windows)."""
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not installed; using the default asyncio event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+def build_client_for(api_key: str) -> genai.Client:
+    return genai.Client(api_key=api_key)
+
+# One client per key, built once at startup; requests are spread over them round-robin.
+# The master configures the pool once for itself and the clones it hosts via configure_gemini().
+gemini_clients: List[genai.Client] = []
+_key_counter = itertools.count()
+# Caps in-flight Gemini requests so a burst queues locally instead of turning into 429s;
+# sized per key by configure_gemini() (override with GEMINI_CALLS_PER_KEY)
+GEMINI_CALLS_PER_KEY = int(os.getenv("GEMINI_CALLS_PER_KEY", "4"))
+gemini_semaphore = asyncio.Semaphore(1)
+
+def configure_gemini(api_keys: List[str]) -> int:
+    """Build one client per key, skipping keys that fail. Returns how many clients are usable."""
+    global gemini_clients, gemini_semaphore
+    clients = []
+    for i, key in enumerate(api_keys):
+        try:
+            clients.append(build_client_for(key))
+        except Exception as e:
+            logger.error("Failed to configure Gemini with key #%d: %s", i + 1, e)
+    gemini_clients = clients
+    key_cooldown_until.clear()
+    invalid_keys.clear()
+    key_next_slot.clear()
+    key_in_flight.clear()
+    key_send_interval.clear()
+    gemini_semaphore = asyncio.Semaphore(max(1, len(clients) * GEMINI_CALLS_PER_KEY))
+    if clients:
+        logger.info("Configured Gemini with %d of %d API key(s)", len(clients), len(api_keys))
+    else:
+        logger.warning("No usable Gemini API keys; model responses are disabled.")
+    return len(clients)
+
+def gemini_enabled() -> bool:
+    return bool(gemini_clients)
+
+# Retry policy for Gemini 429s: 0.5s -> 1s -> 2s -> 4s with +/-25% jitter, used once every key is cooling down
+GEMINI_MAX_ATTEMPTS = 5
+GEMINI_BACKOFF_BASE = 0.5
+GEMINI_BACKOFF_CAP = 4.0
+# A key that returned 429 is skipped by pick_key() for this long (quotas are per minute)
+GEMINI_KEY_COOLDOWN = 60.0
+# key index -> time.monotonic() until which that key should not be used
+key_cooldown_until = {}
+# keys Gemini rejected as unauthorized (revoked, disabled, leaked); never picked again
+invalid_keys = set()
+# Optional proactive pacing: each key admits at most GEMINI_KEY_RPM requests per minute, spaced evenly
+# (a token bucket of depth one). 0 leaves pacing to the 429 cooldowns above.
+GEMINI_KEY_RPM = int(os.getenv("GEMINI_KEY_RPM", "0"))
+# key index -> time.monotonic() of the earliest slot that key can next start a request in
+key_next_slot = {}
+# key index -> requests currently streaming on that key
+key_in_flight = Counter()
+# Adaptive pacing (AIMD): every 429 on a key widens the gap between its requests by GEMINI_AIMD_STEP,
+# every success halves it, so keys sharing a project quota settle just below it without coordination
+GEMINI_AIMD_STEP = 0.25
+GEMINI_AIMD_MAX = 10.0
+# key index -> learned seconds between request starts on that key
+key_send_interval = {}
+
+def is_quota_error(e: Exception) -> bool:
+    # google-genai raises ClientError with the HTTP status in .code for RESOURCE_EXHAUSTED
+    return isinstance(e, genai_errors.APIError) and e.code == 429
+
+def is_key_error(e: Exception) -> bool:
+    return isinstance(e, genai_errors.APIError) and e.code in (401, 403)
+
+def key_is_ready(idx: int) -> bool:
+    return idx not in invalid_keys and key_cooldown_until.get(idx, 0.0) <= time.monotonic()
+
+def pick_key() -> int:
+    """Least-loaded key that isn't cooling down (earliest free slot, then fewest in flight; ties go
+    round-robin). If every key is cooling down, the one that recovers first."""
+    n = len(gemini_clients)
+    start = next(_key_counter)
+    ready = [idx for idx in ((start + step) % n for step in range(n)) if key_is_ready(idx)]
+    if not ready:
+        usable = [i for i in range(n) if i not in invalid_keys] or range(n)
+        return min(usable, key=lambda i: key_cooldown_until.get(i, 0.0))
+    now = time.monotonic()
+    # min() returns the first of equal keys, so the rotated order breaks ties
+    return min(ready, key=lambda i: (max(key_next_slot.get(i, 0.0), now), key_in_flight[i]))
+
+def key_spacing(idx: int) -> float:
+    """Seconds between request starts on key idx: the configured RPM or the learned AIMD gap, whichever is wider."""
+    configured = 60.0 / GEMINI_KEY_RPM if GEMINI_KEY_RPM else 0.0
+    return max(configured, key_send_interval.get(idx, 0.0))
+
+def note_key_success(idx: int):
+    interval = key_send_interval.get(idx, 0.0) * 0.5
+    # below 10ms the gap is noise; drop it so an idle key is unpaced again
+    if interval < 0.01:
+        key_send_interval.pop(idx, None)
+    else:
+        key_send_interval[idx] = interval
+
+def note_key_throttled(idx: int):
+    key_send_interval[idx] = min(key_send_interval.get(idx, 0.0) + GEMINI_AIMD_STEP, GEMINI_AIMD_MAX)
+
+async def wait_for_key_slot(idx: int):
+    spacing = key_spacing(idx)
+    if not spacing:
+        return
+    now = time.monotonic()
+    slot = max(now, key_next_slot.get(idx, 0.0))
+    key_next_slot[idx] = slot + spacing
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+@lru_cache(maxsize=1024)
+def gemini_config(instructions: str):
+    """Request config carrying the user's instructions as a system instruction (built once per distinct text)."""
+    return types.GenerateContentConfig(system_instruction=instructions) if instructions else None
+
+def quota_retry_delay(e: Exception) -> Optional[float]:
+    """Wait the server suggests in the 429's google.rpc.RetryInfo detail (retryDelay like "17s"), if any."""
+    details = getattr(e, "details", None)
+    if isinstance(details, dict):
+        # the error body may be wrapped in {"error": {...}}; proxies sometimes put a string there
+        error = details.get("error", details)
+        details = error.get("details") if isinstance(error, dict) else None
+    if not isinstance(details, list):
+        return None
+    for detail in details:
+        if isinstance(detail, dict) and str(detail.get("@type", "")).endswith("google.rpc.RetryInfo"):
+            try:
+                return float(str(detail.get("retryDelay", "")).rstrip("s"))
+            except ValueError:
+                return None
+    return None
+
+async def backoff_after_quota_error(idx: int, attempt: int, retry_delay: Optional[float] = None):
+    # the server's RetryInfo, when present, says exactly how long this key stays exhausted
+    cooldown = GEMINI_KEY_COOLDOWN if retry_delay is None else retry_delay
+    key_cooldown_until[idx] = time.monotonic() + cooldown
+    if any(key_is_ready(i) for i in range(len(gemini_clients))):
+        # another key is still fresh: pick_key() will hand it out on the retry
+        logger.warning("Gemini quota hit on key #%d, cooling it down for %.0fs", idx + 1, cooldown)
+        return
+    # whole pool is throttled: wait out the backoff (at least the server's hint, within the cap) before trying again
+    delay = min(max(GEMINI_BACKOFF_BASE * 2 ** attempt, retry_delay or 0.0), GEMINI_BACKOFF_CAP) * random.uniform(0.75, 1.25)
+    logger.warning("All Gemini keys throttled, backing off %.2fs (attempt %d)", delay, attempt + 1)
+    await asyncio.sleep(delay)
+
+# Longer prompts are answered locally: Gemini would reject them after a full round-trip anyway
+GEMINI_MAX_PROMPT_CHARS = 24000
+
+def prompt_too_long(prompt: str, instructions: str = "") -> bool:
+    return len(prompt) + len(instructions) > GEMINI_MAX_PROMPT_CHARS
+
+# Identical prompts (same instructions + same message) are answered from memory for a while (L1),
+# then from SQLite for up to an hour (L2, shared by restarts). The key covers the instructions text,
+# so /set_instructions or /clear_instructions never see replies made under the old instructions.
+GEMINI_CACHE_SIZE = 5000
+GEMINI_CACHE_TTL = 600
+gemini_cache = TTLCache(maxsize=GEMINI_CACHE_SIZE, ttl=GEMINI_CACHE_TTL)
+GEMINI_L2_TTL = 3600
+# expired L2 rows are deleted once every this many writes
+GEMINI_L2_PRUNE_EVERY = 500
+_l2_writes = itertools.count(1)
+# L2 rows hold zlib-compressed UTF-8
+GEMINI_L2_COMPRESSION_LEVEL = 6
+
+def gemini_cache_key(prompt: str, instructions: str) -> bytes:
+    return blake2b(f"{instructions}\x00{prompt}".encode(), digest_size=16).digest()
+
+async def cached_reply(key: bytes):
+    text = gemini_cache.get(key)
+    if text is None:
+        stored = await asyncio.to_thread(get_cached_response, key, int(time.time()) - GEMINI_L2_TTL)
+        if stored is not None:
+            text = zlib.decompress(stored).decode()
+            gemini_cache[key] = text
+    return text
+
+def _store_l2(key: bytes, text: str):
+    now = int(time.time())
+    try:
+        save_cached_response(key, zlib.compress(text.encode(), GEMINI_L2_COMPRESSION_LEVEL), now)
+        if next(_l2_writes) % GEMINI_L2_PRUNE_EVERY == 0:
+            prune_cached_responses(now - GEMINI_L2_TTL)
+    except Exception as e:
+        logger.warning("Could not store Gemini reply in the response cache: %s", e)
+
+def remember_reply(key: bytes, text: str):
+    gemini_cache[key] = text
+    # the SQLite write runs off the event loop and nobody waits for it
+    asyncio.get_running_loop().run_in_executor(None, _store_l2, key, text)
+
+async def generate_streaming(prompt: str, config, publish) -> str:
+    """One Gemini reply under gemini_semaphore, passing the text so far to publish() as it grows.
+
+    429s are retried with backoff only before the first chunk; once text has been published the
+    error is raised, since the caller may already have shown part of the answer.
+    """
+    text = ""
+    async with gemini_semaphore:
+        for attempt in range(GEMINI_MAX_ATTEMPTS):
+            idx = pick_key()
+            await wait_for_key_slot(idx)
+            key_in_flight[idx] += 1
+            try:
+                stream = await gemini_clients[idx].aio.models.generate_content_stream(
+                    model=GEMINI_MODEL, contents=prompt, config=config
+                )
+                async for chunk in stream:
+                    if chunk.text:
+                        text += chunk.text
+                        publish(text)
+                note_key_success(idx)
+                break
+            except genai_errors.APIError as e:
+                if text or attempt == GEMINI_MAX_ATTEMPTS - 1:
+                    raise
+                if is_key_error(e):
+                    invalid_keys.add(idx)
+                    logger.error("Gemini rejected key #%d (%s); no longer using it", idx + 1, e.code)
+                    if len(invalid_keys) == len(gemini_clients):
+                        raise
+                    continue
+                if not is_quota_error(e):
+                    raise
+                note_key_throttled(idx)
+                retry_delay = quota_retry_delay(e)
+            finally:
+                key_in_flight[idx] -= 1
+            await backoff_after_quota_error(idx, attempt, retry_delay)
+    return text
+
+async def stream_generate(prompt: str, instructions: str = ""):
+    """Yield the reply text as it grows. Cached replies come back in one piece.
+
+    Gemini is read by a separate task, so the semaphore slot is held only while Gemini streams, not
+    while the caller sends or edits Telegram messages. A slow consumer skips intermediate versions
+    and gets the newest text; the last one yielded is always the full reply.
+    """
+    # prompts without instructions are never cached (or served from it), so one bot's chatter
+    # can't poison the replies of every other instruction-less bot
+    key = gemini_cache_key(prompt, instructions) if instructions else None
+    cached = await cached_reply(key) if key else None
+    if cached is not None:
+        yield cached
+        return
+    latest = ""
+    progressed = asyncio.Event()
+
+    def publish(text: str):
+        nonlocal latest
+        latest = text
+        progressed.set()
+
+    producer = asyncio.create_task(generate_streaming(prompt, gemini_config(instructions), publish))
+    producer.add_done_callback(lambda _: progressed.set())
+    try:
+        shown = ""
+        while not producer.done():
+            await progressed.wait()
+            progressed.clear()
+            if latest != shown:
+                shown = latest
+                yield shown
+        # raises whatever ended the Gemini call
+        text = producer.result()
+        if text != shown:
+            yield text
+    finally:
+        if not producer.done():
+            producer.cancel()
+    if text and key:
+        remember_reply(key, text)
+
+# Streamed replies are edited in place at most this often, and only once enough new text arrived,
+# to stay well inside Telegram's per-chat edit limits
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_EDIT_MIN_CHARS = 80
+EMPTY_REPLY = "⚠️ I couldn't come up with a reply to that. Try rephrasing?"
+# Telegram rejects longer messages; longer replies continue in follow-up messages
+TELEGRAM_MAX_CHARS = 4096
+# without this Telegram fetches a preview for the first URL in every reply
+NO_LINK_PREVIEW = LinkPreviewOptions(is_disabled=True)
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_CHARS) -> List[str]:
+    """Split text into parts Telegram accepts, cutting at a paragraph, line or word break near the limit."""
+    parts = []
+    while len(text) > limit:
+        window = text[:limit]
+        for sep in ("\n\n", "\n", " "):
+            cut = window.rfind(sep)
+            if cut >= limit // 2:
+                break
+        else:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return parts
+
+async def reply_streaming(message, prompt: str, instructions: str = "", finalize=None):
+    """Reply to message with Gemini's answer, editing it as the stream progresses.
+
+    Text past Telegram's length limit continues in a new message. finalize, if given, maps the
+    complete text to what is finally shown (e.g. to add a watermark).
+    """
+    sent = []  # one Telegram message per part of the reply
+    shown = ""  # what the last of them currently displays
+    last_edit = 0.0
+
+    async def show(parts: List[str], final: bool):
+        nonlocal shown, last_edit
+        # only the newest sent message can still change; everything after it is new
+        for i in range(max(len(sent) - 1, 0), len(parts)):
+            part = parts[i]
+            if i == len(sent):
+                sent.append(await message.reply_text(part, link_preview_options=NO_LINK_PREVIEW))
+                shown, last_edit = part, time.monotonic()
+                continue
+            if part == shown:
+                continue
+            complete = final or i < len(parts) - 1
+            if not complete and (
+                time.monotonic() - last_edit < STREAM_EDIT_INTERVAL or len(part) - len(shown) < STREAM_EDIT_MIN_CHARS
+            ):
+                continue
+            try:
+                await sent[i].edit_text(part, link_preview_options=NO_LINK_PREVIEW)
+                shown = part
+            except TelegramError as e:
+                if complete:
+                    raise
+                # intermediate edits are best-effort; a later edit carries the full text
+                logger.debug("Skipped intermediate edit: %s", e)
+            last_edit = time.monotonic()
+
+    text = ""
+    stream = stream_generate(prompt, instructions)
+    try:
+        async for text in stream:
+            await show(split_message(text), final=False)
+    finally:
+        # a failed send/edit leaves the generator suspended; closing it cancels the Gemini call now
+        await stream.aclose()
+    final = text or EMPTY_REPLY
+    if finalize:
+        final = finalize(final)
+    await show(split_message(final), final=True)
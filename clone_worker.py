@@ -1,77 +1,83 @@
 import os
 import sys
-import logging
 import asyncio
+import logging
+import weakref
 from typing import List
 
-from db import get_clone, save_clone, get_referral, REFERRAL_THRESHOLD
+from cachetools import TTLCache
 
-# genai (Gemini)
-import google.generativeai as genai
+from db import get_clone, get_clone_chat_state, update_clone_instructions, REFERRAL_THRESHOLD
+from bot_core import application_builder, install_uvloop, configure_gemini, reply_streaming, gemini_enabled, is_quota_error, prompt_too_long
 
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram import Update
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("clone_worker")
 
-CLONE_USER_ID = os.getenv("CLONE_USER_ID")
-if CLONE_USER_ID is None:
-    logger.error("CLONE_USER_ID env var required")
-    sys.exit(2)
-CLONE_USER_ID = int(CLONE_USER_ID)
-
+# Clones normally run inside the master's event loop (see build_clone_application); running this
+# file directly still hosts a single clone in its own process, selected by CLONE_USER_ID.
+# Which GEMINI_API_KEY_<n> variables belong to the clones, e.g. "4,5,6"
+GEMINI_API_KEY_SLOTS = [s.strip() for s in os.getenv("GEMINI_API_KEY_SLOTS", "4,5,6").split(",") if s.strip()]
 GEMINI_API_KEYS: List[str] = [
-    k for k in [
-        os.getenv("GEMINI_API_KEY_4"),
-        os.getenv("GEMINI_API_KEY_5"),
-        os.getenv("GEMINI_API_KEY_6"),
-    ] if k
+    k for k in (os.getenv(f"GEMINI_API_KEY_{slot}") for slot in GEMINI_API_KEY_SLOTS) if k
 ]
-current_key_index = 0
-model = None
-
-def configure_gemini():
-    global model, current_key_index
-    if not GEMINI_API_KEYS:
-        logger.warning("No GEMINI_API_KEYS configured; model responses will be disabled.")
-        model = None
-        return
-    try:
-        genai.configure(api_key=GEMINI_API_KEYS[current_key_index])
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        logger.info("Gemini configured with key #%d", current_key_index + 1)
-    except Exception as e:
-        logger.error("Failed to configure Gemini with key #%d: %s", current_key_index + 1, e)
-        if len(GEMINI_API_KEYS) > 1:
-            current_key_index = (current_key_index + 1) % len(GEMINI_API_KEYS)
-            configure_gemini()
-        else:
-            model = None
-
-def rotate_gemini_key():
-    global current_key_index
-    if not GEMINI_API_KEYS:
-        return
-    current_key_index = (current_key_index + 1) % len(GEMINI_API_KEYS)
-    configure_gemini()
-    logger.warning("Rotated Gemini API key to index %d", current_key_index + 1)
 
-def owner_remaining_referrals() -> (int, bool):
-    row = get_referral(CLONE_USER_ID)
-    if not row:
-        return REFERRAL_THRESHOLD, False
-    remaining = max(0, REFERRAL_THRESHOLD - row["count"])
-    return remaining, row["verified"]
+def owner_id(context: ContextTypes.DEFAULT_TYPE) -> int:
+    return context.bot_data["owner_id"]
+
+# owner id -> get_clone_chat_state() row, so a busy clone reads the DB at most every CHAT_STATE_TTL
+# seconds. Writers in this process (the instruction commands here, referral updates and re-clones in
+# the master) evict entries directly; the TTL bounds staleness from anything else.
+CHAT_STATE_TTL = 30
+NO_CHAT_STATE = {"instructions": "", "count": 0, "verified": False, "owner_username": ""}
+chat_states = TTLCache(maxsize=10_000, ttl=CHAT_STATE_TTL)
+
+async def get_chat_state(owner: int) -> dict:
+    state = chat_states.get(owner)
+    if state is None:
+        state = await asyncio.to_thread(get_clone_chat_state, owner) or NO_CHAT_STATE
+        chat_states[owner] = state
+    return state
+
+def forget_chat_state(owner: int):
+    chat_states.pop(owner, None)
+
+WATERMARK_HANDLE = os.getenv("WATERMARK_HANDLE", "aimastercreatorrobot")
+WATERMARK_TEMPLATE = (
+    "\n\n┈┈┈┈┈┈┈┈┈┈┈┈\n"
+    f"🔹 Made by @{WATERMARK_HANDLE}\n"
+    "📊 {remaining} referrals needed to remove watermark"
+)
+
+# remaining can only be 0..REFERRAL_THRESHOLD, so every variant is rendered once at import
+WATERMARKS = tuple(WATERMARK_TEMPLATE.format(remaining=r) for r in range(REFERRAL_THRESHOLD + 1))
+
+def with_watermark(text: str, state: dict) -> str:
+    """Append the referral watermark until the owner has reached the referral threshold."""
+    if state["verified"]:
+        return text
+    return text + WATERMARKS[max(0, REFERRAL_THRESHOLD - state["count"])]
+
+# (owner id, chat id) -> lock held while that chat's reply is generated, so a chat's replies go out in
+# the order its messages came in while other chats (and other clones) proceed concurrently. Weak
+# values drop a chat's lock once no handler holds or waits on it.
+chat_reply_locks = weakref.WeakValueDictionary()
+
+def chat_reply_lock(owner: int, chat_id: int) -> asyncio.Lock:
+    lock = chat_reply_locks.get((owner, chat_id))
+    if lock is None:
+        chat_reply_locks[(owner, chat_id)] = lock = asyncio.Lock()
+    return lock
 
 # New start handler that identifies owner
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sender = update.effective_user
     sender_name = sender.first_name or sender.username or str(sender.id)
-    clone = get_clone(CLONE_USER_ID)
-    owner_username = clone.get("owner_username", "") if clone else ""
+    owner = owner_id(context)
+    owner_username = (await get_chat_state(owner))["owner_username"]
     # If owner_username is empty, fall back to textual owner id
-    owner_display = f"@{owner_username}" if owner_username else f"user_{CLONE_USER_ID}"
+    owner_display = f"@{owner_username}" if owner_username else f"user_{owner}"
     # Compose greeting exactly as requested
     await update.message.reply_text(f"Hey {sender_name}, I am {owner_display} ai do you understand what I mean?")
 
@@ -79,100 +85,95 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Below are minimal placeholders (replace with your full implementations that call model.generate_content etc.)
 
 async def set_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    sender_id = update.effective_user.id
-    if sender_id != CLONE_USER_ID:
+    owner = owner_id(context)
+    if update.effective_user.id != owner:
         await update.message.reply_text("❌ Only the owner can change instructions.")
         return
-    clone = get_clone(CLONE_USER_ID)
-    if not clone:
-        await update.message.reply_text("❌ Clone record not found.")
-        return
     args = context.args or []
     if args:
         new_instructions = " ".join(args).strip()
         try:
-            save_clone(CLONE_USER_ID, clone["token"], clone.get("bot_username", ""), new_instructions, clone.get("owner_username",""))
-            await update.message.reply_text("✅ Instructions updated.")
+            found = await asyncio.to_thread(update_clone_instructions, owner, new_instructions)
         except Exception as e:
             logger.error("Failed saving instructions: %s", e)
             await update.message.reply_text("❌ Failed to save instructions.")
+            return
+        forget_chat_state(owner)
+        await update.message.reply_text("✅ Instructions updated." if found else "❌ Clone record not found.")
     else:
-        current = clone.get("instructions", "") or "(none)"
+        current = (await get_chat_state(owner))["instructions"] or "(none)"
         await update.message.reply_text(f"📝 Current instructions:\n\n{current}\n\nTo change: /set_instructions [text]\nTo clear: /clear_instructions")
 
 async def clear_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    sender_id = update.effective_user.id
-    if sender_id != CLONE_USER_ID:
+    owner = owner_id(context)
+    if update.effective_user.id != owner:
         await update.message.reply_text("❌ Only the owner can clear instructions.")
         return
-    clone = get_clone(CLONE_USER_ID)
-    if not clone:
-        await update.message.reply_text("❌ Clone record not found.")
-        return
     try:
-        save_clone(CLONE_USER_ID, clone["token"], clone.get("bot_username", ""), "", clone.get("owner_username",""))
-        await update.message.reply_text("✅ Instructions cleared.")
+        found = await asyncio.to_thread(update_clone_instructions, owner, "")
     except Exception as e:
         logger.error("Failed clearing instructions: %s", e)
         await update.message.reply_text("❌ Failed to clear instructions.")
+        return
+    forget_chat_state(owner)
+    await update.message.reply_text("✅ Instructions cleared." if found else "❌ Clone record not found.")
 
 async def chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # keep your previously working model code here; this placeholder maintains watermark logic
-    clone = get_clone(CLONE_USER_ID)
-    instructions = clone.get("instructions", "") if clone else ""
+    # Gemini calls go through the shared key pool in bot_core; the watermark is appended by with_watermark
+    # instructions and referral progress in one (cached) query, off the event loop the master shares
+    owner = owner_id(context)
+    state = await get_chat_state(owner)
+    instructions = state["instructions"]
     user_text = update.message.text or ""
-    if model is None:
+    if not gemini_enabled():
         base_response = f"{instructions}\n\nYou said: {user_text}" if instructions else f"You said: {user_text}"
-        remaining, verified = owner_remaining_referrals()
-        if not verified:
-            watermark = (
-                "\n\n┈┈┈┈┈┈┈┈┈┈┈┈\n"
-                "🔹 Made by @aimastercreatorrobot\n"
-                f"📊 {remaining} referrals needed to remove watermark"
-            )
-            base_response += watermark
-        await update.message.reply_text(base_response)
+        await update.message.reply_text(with_watermark(base_response, state))
         return
 
-    prompt = f"{instructions}\n\nUser: {user_text}" if instructions else user_text
-    try:
-        gen_response = await asyncio.to_thread(model.generate_content, prompt)
-        response_text = getattr(gen_response, "text", None) or str(gen_response)
-        remaining, verified = owner_remaining_referrals()
-        if not verified:
-            watermark = (
-                "\n\n┈┈┈┈┈┈┈┈┈┈┈┈\n"
-                "🔹 Made by @aimastercreatorrobot\n"
-                f"📊 {remaining} referrals needed to remove watermark"
-            )
-            response_text += watermark
-        await update.message.reply_text(response_text)
-    except Exception as e:
-        err_str = str(e).lower()
-        logger.error("Gemini error: %s", e)
-        if "429" in err_str or "quota" in err_str or "rate" in err_str:
-            rotate_gemini_key()
-            await update.message.reply_text("Bug error😥 — please try again.")
-        else:
-            await update.message.reply_text("⚠️ Sorry, I couldn't process that right now. Try again later")
-
-def main():
-    configure_gemini()
-    clone = get_clone(CLONE_USER_ID)
-    if not clone:
-        logger.error("No clone record in DB for user %s", CLONE_USER_ID)
-        sys.exit(3)
-    token = clone["token"]
-    username = clone.get("bot_username", "unknown")
-    logger.info("Starting clone worker for user %s (%s)", CLONE_USER_ID, username)
+    if prompt_too_long(user_text, instructions):
+        await update.message.reply_text("⚠️ Your message is too long. Please send a shorter one.")
+        return
 
-    app = ApplicationBuilder().token(token).build()
+    async with chat_reply_lock(owner, update.effective_chat.id):
+        try:
+            await reply_streaming(update.message, user_text, instructions, finalize=lambda text: with_watermark(text, state))
+        except Exception as e:
+            logger.error("Gemini error: %s", e)
+            if is_quota_error(e):
+                await update.message.reply_text("Bug error😥 — please try again.")
+            else:
+                await update.message.reply_text("⚠️ Sorry, I couldn't process that right now. Try again later")
+
+def build_clone_application(owner: int, token: str, request=None) -> Application:
+    """Application for one clone bot; the caller drives initialize/start/polling and shutdown.
+
+    request is passed on to application_builder so clones hosted together can share one outbound pool.
+    """
+    # concurrent updates: one user's slow Gemini reply doesn't hold up anyone else's /start or message;
+    # bot_core's semaphore still caps in-flight Gemini calls for the whole process
+    app = application_builder(token, request).concurrent_updates(True).build()
+    app.bot_data["owner_id"] = owner
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("set_instructions", set_instructions))
     app.add_handler(CommandHandler("clear_instructions", clear_instructions))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_handler))
+    return app
 
-    app.run_polling()
+def main():
+    logging.basicConfig(level=logging.INFO)
+    owner = os.getenv("CLONE_USER_ID")
+    if owner is None:
+        logger.error("CLONE_USER_ID env var required")
+        sys.exit(2)
+    owner = int(owner)
+    configure_gemini(GEMINI_API_KEYS)
+    clone = get_clone(owner)
+    if not clone:
+        logger.error("No clone record in DB for user %s", owner)
+        sys.exit(3)
+    logger.info("Starting clone worker for user %s (%s)", owner, clone.get("bot_username", "unknown"))
+    install_uvloop()
+    build_clone_application(owner, clone["token"]).run_polling()
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,22 @@
 import os
+import base64
+import hashlib
+import logging
+import queue
 import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 from typing import List, Dict, Optional
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from datetime import datetime
 
+logger = logging.getLogger("db")
+
 DB_PATH = os.getenv("DB_PATH", "clones.db")
 MASTER_KEY = os.getenv("MASTER_KEY")  # must be set (Fernet key)
 REFERRAL_THRESHOLD = int(os.getenv("REFERRAL_THRESHOLD", "5"))
@@ -11,12 +24,80 @@ REFERRAL_THRESHOLD = int(os.getenv("REFERRAL_THRESHOLD", "5"))
 if MASTER_KEY is None:
     raise RuntimeError("MASTER_KEY environment variable is required to encrypt tokens. Generate with Fernet.generate_key().")
 
-def get_fernet() -> Fernet:
-    return Fernet(MASTER_KEY.encode())
+# built once: the constructor decodes and splits the key, and the instance is safe to share between threads
+_FERNET = Fernet(MASTER_KEY.encode())
+
+def derive_key(purpose: bytes, length: int = 32) -> bytes:
+    """Independent subkey of MASTER_KEY for one purpose (HKDF-SHA256), so the master key itself is used only by Fernet."""
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=None, info=purpose).derive(base64.urlsafe_b64decode(MASTER_KEY))
+
+# Tokens are stored as 0x02 || 12-byte nonce || AES-256-GCM ciphertext and tag: one accelerated pass,
+# no padding. Rows written before hold Fernet tokens (base64 text, never starting with 0x02) and are
+# still read through _FERNET. The GCM key is derived from MASTER_KEY, so no new secret is needed.
+TOKEN_FORMAT_AESGCM = b"\x02"
+_AESGCM = AESGCM(derive_key(b"clone-token-aesgcm"))
+
+def encrypt_token(token_plain: str) -> bytes:
+    nonce = os.urandom(12)
+    return TOKEN_FORMAT_AESGCM + nonce + _AESGCM.encrypt(nonce, token_plain.encode(), None)
+
+def decrypt_token(token_enc: bytes) -> str:
+    """Plaintext of a stored token in either format; raises InvalidToken for a wrong key or corrupted blob."""
+    if token_enc[:1] == TOKEN_FORMAT_AESGCM:
+        try:
+            return _AESGCM.decrypt(token_enc[1:13], token_enc[13:], None).decode()
+        except InvalidTag:
+            raise InvalidToken
+    return _FERNET.decrypt(token_enc).decode()
+
+def token_hash(token_plain: str) -> bytes:
+    """Deterministic lookup key for a bot token (the stored ciphertext differs on every encryption)."""
+    return hashlib.sha256(token_plain.encode()).digest()
+
+def _migrate_token_hashes(cur):
+    """Add clones.token_sha256 to databases created before it existed and fill it in for old rows."""
+    columns = {r[1] for r in cur.execute("PRAGMA table_info(clones)").fetchall()}
+    if "token_sha256" not in columns:
+        cur.execute("ALTER TABLE clones ADD COLUMN token_sha256 BLOB")
+    rows = cur.execute("SELECT user_id, token_encrypted, active FROM clones WHERE token_sha256 IS NULL ORDER BY user_id").fetchall()
+    if rows:
+        seen = {r[0] for r in cur.execute("SELECT token_sha256 FROM clones WHERE token_sha256 IS NOT NULL AND active=1").fetchall()}
+        for user_id, token_enc, active in rows:
+            try:
+                digest = token_hash(decrypt_token(token_enc))
+            except InvalidToken:
+                continue
+            # one bot active under two accounts: the oldest active row keeps the hash
+            if active:
+                if digest in seen:
+                    continue
+                seen.add(digest)
+            cur.execute("UPDATE clones SET token_sha256=? WHERE user_id=?", (digest, user_id))
+    # only active clones must not share a token, so a retired clone's token can be cloned again
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_clones_active_tokhash ON clones(token_sha256) WHERE active=1")
+
+# Each connection keeps this many prepared statements, keyed by SQL text, so the hot queries (kept
+# as constants below) are parsed once per connection rather than on every call
+SQL_STATEMENT_CACHE = 256
 
 def init_db(path: str = DB_PATH):
-    conn = sqlite3.connect(path, check_same_thread=False)
+    # timeout is SQLite's busy timeout: wait up to 5s for another process's write lock instead of failing
+    # IMMEDIATE: writes take the write lock when their transaction opens, not halfway through it
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0, isolation_level="IMMEDIATE",
+                           cached_statements=SQL_STATEMENT_CACHE)
     cur = conn.cursor()
+    # WAL lets the master and clone workers read while one of them writes; NORMAL skips the per-commit fsync
+    mode = cur.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if mode.lower() != "wal":
+        # e.g. a filesystem without shared memory support; everything still works, readers just block on writes
+        logger.warning("SQLite database %s stays in %s journal mode, not WAL", path, mode)
+    cur.execute("PRAGMA synchronous=NORMAL")
+    # sorts and temp indexes (ORDER BY, GROUP BY) stay in memory
+    cur.execute("PRAGMA temp_store=MEMORY")
+    # hot pages served from a 256MB memory map and a 64MB page cache instead of read() syscalls
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.execute("PRAGMA wal_autocheckpoint=1000")
     cur.execute("""
     CREATE TABLE IF NOT EXISTS clones (
         user_id INTEGER PRIMARY KEY,
@@ -24,9 +105,11 @@ def init_db(path: str = DB_PATH):
         bot_username TEXT,
         token_encrypted BLOB,
         instructions TEXT,
-        active INTEGER DEFAULT 1
+        active INTEGER DEFAULT 1,
+        token_sha256 BLOB
     )
     """)
+    _migrate_token_hashes(cur)
     cur.execute("""
 CREATE TABLE IF NOT EXISTS users (
     user_id     INTEGER PRIMARY KEY,
@@ -43,45 +126,160 @@ CREATE TABLE IF NOT EXISTS users (
         verified INTEGER DEFAULT 0
     )
     """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS referral_joins (
+        user_id INTEGER PRIMARY KEY,
+        referrer_id INTEGER NOT NULL,
+        joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS gemini_responses (
+        key BLOB PRIMARY KEY,
+        text BLOB NOT NULL,
+        ts INTEGER NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_instructions (
+        user_id INTEGER PRIMARY KEY,
+        instructions TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # list_recent_instructions reads the newest rows straight off this index instead of sorting the table
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_instructions_updated ON user_instructions(updated_at)")
+    # partial index over active clones only: the startup respawn reads it without scanning retired rows
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_clones_active ON clones(user_id) WHERE active=1")
     conn.commit()
     return conn
 
+# _conn is the one read-write connection, and only the writer thread below uses it after init.
+# Writers queue their statement and wait; the thread runs whatever has queued up meanwhile (up to
+# WRITE_BATCH_MAX statements) in one transaction, so concurrent writes share one commit instead of
+# paying one each. Each statement runs under its own savepoint, so a failing one (e.g. a unique
+# violation) is rolled back and reported to its caller alone. Callers return only after the commit.
 _conn = init_db(DB_PATH)
+WRITE_BATCH_MAX = 500
+_write_queue = queue.SimpleQueue()
 
-def save_clone(user_id: int, token_plain: str, bot_username: str, instructions: str, owner_username: str = ""):
-    """
-    Save or update a clone record. owner_username is the Telegram username of the owner
-    (the person who created the clone). If not provided it will default to empty string.
+def _changed_one_row(cur: sqlite3.Cursor) -> bool:
+    return cur.rowcount == 1
+
+def _execute_write(sql: str, params=(), many: bool = False, result=None):
+    """Run one write statement in the writer's next group commit and wait for it to be committed.
+
+    result, if given, is called with the cursor inside the transaction and its value is returned.
     """
-    f = get_fernet()
-    token_enc = f.encrypt(token_plain.encode())
-    cur = _conn.cursor()
-    cur.execute("""
-    INSERT INTO clones (user_id, owner_username, bot_username, token_encrypted, instructions, active)
-    VALUES (?, ?, ?, ?, ?, 1)
+    future = Future()
+    _write_queue.put((sql, params, many, result, future))
+    return future.result()
+
+def _writer_loop():
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        outcomes = []
+        try:
+            _conn.execute("BEGIN IMMEDIATE")
+            for sql, params, many, result, future in batch:
+                _conn.execute("SAVEPOINT write_op")
+                try:
+                    cur = _conn.executemany(sql, params) if many else _conn.execute(sql, params)
+                    outcomes.append((future, result(cur) if result else None, None))
+                except Exception as e:
+                    _conn.execute("ROLLBACK TO write_op")
+                    outcomes.append((future, None, e))
+                _conn.execute("RELEASE write_op")
+            _conn.commit()
+        except Exception as e:
+            # BEGIN or COMMIT itself failed (e.g. another process held the lock past the busy timeout)
+            if _conn.in_transaction:
+                _conn.rollback()
+            logger.error("Group commit of %d write(s) failed: %s", len(batch), e)
+            for *_, future in batch:
+                future.set_exception(e)
+            continue
+        for future, value, error in outcomes:
+            if error is None:
+                future.set_result(value)
+            else:
+                future.set_exception(error)
+
+threading.Thread(target=_writer_loop, name="db-writer", daemon=True).start()
+
+# Reads use a pool of read-only connections instead, so with WAL they run in parallel with each
+# other and with the writer. Connections are opened on first use, at most one per concurrent reader
+# thread, and kept for reuse.
+_readers = queue.SimpleQueue()
+
+def _open_reader(path: str = DB_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True, check_same_thread=False, timeout=5.0,
+                           cached_statements=SQL_STATEMENT_CACHE)
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-16384")
+    return conn
+
+@contextmanager
+def reader():
+    try:
+        conn = _readers.get_nowait()
+    except queue.Empty:
+        conn = _open_reader()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+UPSERT_CLONE_SQL = """
+    INSERT INTO clones (user_id, owner_username, bot_username, token_encrypted, instructions, active, token_sha256)
+    VALUES (?, ?, ?, ?, ?, 1, ?)
     ON CONFLICT(user_id) DO UPDATE SET
         owner_username=excluded.owner_username,
         bot_username=excluded.bot_username,
         token_encrypted=excluded.token_encrypted,
         instructions=excluded.instructions,
-        active=1
-    """, (user_id, owner_username, bot_username, token_enc, instructions))
-    _conn.commit()
+        active=1,
+        token_sha256=excluded.token_sha256
+    """
+
+def save_clone(user_id: int, token_plain: str, bot_username: str, instructions: str, owner_username: str = ""):
+    """
+    Save or update a clone record. owner_username is the Telegram username of the owner
+    (the person who created the clone). If not provided it will default to empty string.
+    """
+    token_enc = encrypt_token(token_plain)
+    _execute_write(UPSERT_CLONE_SQL, (user_id, owner_username, bot_username, token_enc, instructions, token_hash(token_plain)))
+
+def save_clones(records: List[tuple]):
+    """save_clone for many (user_id, token_plain, bot_username, instructions, owner_username) tuples in one transaction."""
+    rows = [
+        (user_id, owner_username, bot_username, encrypt_token(token_plain), instructions, token_hash(token_plain))
+        for user_id, token_plain, bot_username, instructions, owner_username in records
+    ]
+    _execute_write(UPSERT_CLONE_SQL, rows, many=True)
 
 def deactivate_clone(user_id: int):
-    cur = _conn.cursor()
-    cur.execute("UPDATE clones SET active=0 WHERE user_id=?", (user_id,))
-    _conn.commit()
+    _execute_write("UPDATE clones SET active=0 WHERE user_id=?", (user_id,))
 
-def get_clone(user_id: int) -> Optional[Dict]:
-    cur = _conn.cursor()
-    cur.execute("SELECT user_id, owner_username, bot_username, token_encrypted, instructions, active FROM clones WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        return None
-    f = get_fernet()
+CLONE_COLUMNS = "user_id, owner_username, bot_username, token_encrypted, instructions, active"
+GET_CLONE_SQL = f"SELECT {CLONE_COLUMNS} FROM clones WHERE user_id=?"
+GET_CLONE_BY_TOKEN_SQL = f"SELECT {CLONE_COLUMNS} FROM clones WHERE token_sha256=? AND active=1"
+LIST_ACTIVE_CLONES_SQL = f"SELECT {CLONE_COLUMNS} FROM clones WHERE active=1"
+CLONE_CHAT_STATE_SQL = """
+    SELECT c.instructions, r.count, r.verified, c.owner_username
+    FROM clones c LEFT JOIN referrals r ON r.user_id = c.user_id
+    WHERE c.user_id=?
+    """
+GET_REFERRAL_SQL = "SELECT user_id, count, verified FROM referrals WHERE user_id=?"
+
+def _clone_from_row(row: tuple) -> Dict:
     try:
-        token = f.decrypt(row[3]).decode()
+        token = decrypt_token(row[3])
     except InvalidToken:
         raise RuntimeError("Failed to decrypt token: invalid MASTER_KEY or corrupted DB")
     return {
@@ -93,84 +291,183 @@ def get_clone(user_id: int) -> Optional[Dict]:
         "active": bool(row[5])
     }
 
+def get_clone(user_id: int) -> Optional[Dict]:
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute(GET_CLONE_SQL, (user_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        return _clone_from_row(row)
+
+def get_clone_by_token(token_plain: str) -> Optional[Dict]:
+    """The active clone (of any owner) running this bot token, found through the token hash index."""
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute(GET_CLONE_BY_TOKEN_SQL, (token_hash(token_plain),))
+        row = cur.fetchone()
+        if not row:
+            return None
+        clone = _clone_from_row(row)
+        return clone if clone["token"] == token_plain else None
+
 def list_active_clones() -> List[Dict]:
-    cur = _conn.cursor()
-    cur.execute("SELECT user_id FROM clones WHERE active=1")
-    rows = cur.fetchall()
-    results = []
-    for (uid,) in rows:
-        c = get_clone(uid)
-        if c:
-            results.append(c)
-    return results
+    """Every active clone, read in one query; a row whose token no longer decrypts is logged and skipped."""
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute(LIST_ACTIVE_CLONES_SQL)
+        results = []
+        for row in cur.fetchall():
+            try:
+                results.append(_clone_from_row(row))
+            except RuntimeError as e:
+                logger.error("Skipping clone %s: %s", row[0], e)
+        return results
+
+def get_clone_chat_state(user_id: int) -> Optional[Dict]:
+    """What a clone needs per message, in one query: its instructions and the owner's referral progress (no token decryption)."""
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute(CLONE_CHAT_STATE_SQL, (user_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        return {"instructions": row[0] or "", "count": row[1] or 0, "verified": bool(row[2]), "owner_username": row[3] or ""}
+
+def update_clone_instructions(user_id: int, instructions: str) -> bool:
+    """Change only a clone's instructions (the token is not re-encrypted). False if there is no such clone."""
+    return _execute_write("UPDATE clones SET instructions=? WHERE user_id=?", (instructions, user_id), result=_changed_one_row)
+
+def list_active_clone_ids() -> frozenset:
+    """Ids of active clones, without fetching or decrypting their tokens."""
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id FROM clones WHERE active=1")
+        return frozenset(uid for (uid,) in cur.fetchall())
+
+# Master-bot chat instructions (durable store behind the in-memory LRU in bot.py)
+def get_instructions(user_id: int) -> Optional[str]:
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT instructions FROM user_instructions WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+def list_recent_instructions(limit: int) -> List[Dict]:
+    """Most recently updated instructions first; used to pre-warm the in-memory cache."""
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, instructions FROM user_instructions ORDER BY updated_at DESC LIMIT ?", (limit,))
+        return [{"user_id": r[0], "instructions": r[1]} for r in cur.fetchall()]
+
+def save_instructions(user_id: int, instructions: str):
+    _execute_write("""
+    INSERT INTO user_instructions (user_id, instructions, updated_at)
+    VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        instructions=excluded.instructions,
+        updated_at=excluded.updated_at
+    """, (user_id, instructions, datetime.utcnow()))
+
+def delete_instructions(user_id: int):
+    _execute_write("DELETE FROM user_instructions WHERE user_id=?", (user_id,))
+
+# Second-level Gemini response cache (the first level is in memory, see bot_core.py)
+def get_cached_response(key: bytes, min_ts: int):
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT text FROM gemini_responses WHERE key=? AND ts>=?", (key, min_ts))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+def save_cached_response(key: bytes, text: bytes, ts: int):
+    _execute_write("INSERT OR REPLACE INTO gemini_responses(key, text, ts) VALUES (?, ?, ?)", (key, text, ts))
+
+def prune_cached_responses(min_ts: int):
+    _execute_write("DELETE FROM gemini_responses WHERE ts<?", (min_ts,))
 
 # Referral helpers (kept as before)
 def get_referral(user_id: int) -> Optional[Dict]:
-    cur = _conn.cursor()
-    cur.execute("SELECT user_id, count, verified FROM referrals WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        return None
-    return {"user_id": row[0], "count": row[1], "verified": bool(row[2])}
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute(GET_REFERRAL_SQL, (user_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        return {"user_id": row[0], "count": row[1], "verified": bool(row[2])}
+
+ENSURE_REFERRAL_SQL = "INSERT OR IGNORE INTO referrals(user_id, count, verified) VALUES (?, 0, 0)"
 
 def ensure_referral_row(user_id: int):
-    cur = _conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO referrals(user_id, count, verified) VALUES (?, 0, 0)", (user_id,))
-    _conn.commit()
+    _execute_write(ENSURE_REFERRAL_SQL, (user_id,))
 
+# The referral writers below are single upserts: a missing row is created with the new values in
+# the same statement, and increment_referral reads the result back with RETURNING.
 def increment_referral(user_id: int) -> Dict:
-    ensure_referral_row(user_id)
-    cur = _conn.cursor()
-    cur.execute("UPDATE referrals SET count = count + 1 WHERE user_id=?", (user_id,))
-    _conn.commit()
-    cur.execute("SELECT count, verified FROM referrals WHERE user_id=?", (user_id,))
-    count, verified = cur.fetchone()
-    if not bool(verified) and count >= REFERRAL_THRESHOLD:
-        cur.execute("UPDATE referrals SET verified = 1 WHERE user_id=?", (user_id,))
-        _conn.commit()
-        verified = 1
+    count, verified = _execute_write("""
+    INSERT INTO referrals(user_id, count, verified) VALUES (?, 1, ? <= 1)
+    ON CONFLICT(user_id) DO UPDATE SET
+        count = referrals.count + 1,
+        verified = CASE WHEN referrals.count + 1 >= ? THEN 1 ELSE referrals.verified END
+    RETURNING count, verified
+    """, (user_id, REFERRAL_THRESHOLD, REFERRAL_THRESHOLD), result=sqlite3.Cursor.fetchone)
     return {"user_id": user_id, "count": count, "verified": bool(verified)}
 
 def set_referral_verified(user_id: int, verified: bool = True):
-    ensure_referral_row(user_id)
-    cur = _conn.cursor()
-    cur.execute("UPDATE referrals SET verified = ? WHERE user_id=?", (1 if verified else 0, user_id))
-    _conn.commit()
+    _execute_write("""
+    INSERT INTO referrals(user_id, count, verified) VALUES (?, 0, ?)
+    ON CONFLICT(user_id) DO UPDATE SET verified = excluded.verified
+    """, (user_id, 1 if verified else 0))
 
 def set_referral_count(user_id: int, count: int):
-    ensure_referral_row(user_id)
-    cur = _conn.cursor()
     verified = 1 if count >= REFERRAL_THRESHOLD else 0
-    cur.execute("UPDATE referrals SET count = ?, verified = ? WHERE user_id=?", (count, verified, user_id))
-    _conn.commit()
+    _execute_write("""
+    INSERT INTO referrals(user_id, count, verified) VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET count = excluded.count, verified = excluded.verified
+    """, (user_id, count, verified))
+
+def record_referral_join(user_id: int, referrer_id: int) -> bool:
+    """Record that user_id joined via referrer_id. Returns False if user_id had already joined through a referral."""
+    return _execute_write(
+        "INSERT OR IGNORE INTO referral_joins(user_id, referrer_id) VALUES (?, ?)", (user_id, referrer_id), result=_changed_one_row
+    )
+
+UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_name, last_seen)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name  = excluded.last_name,
+        last_seen  = excluded.last_seen
+    """
 
 def upsert_user(user_id: int, username: str = "", first_name: str = "", last_name: str = ""):
-    cur = _conn.cursor()
-    cur.execute("""
-        INSERT INTO users (user_id, username, first_name, last_name, last_seen)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            username = excluded.username,
-            first_name = excluded.first_name,
-            last_name  = excluded.last_name,
-            last_seen  = excluded.last_seen
-    """, (user_id, username, first_name, last_name, datetime.utcnow()))
-    _conn.commit()
+    _execute_write(UPSERT_USER_SQL, (user_id, username, first_name, last_name, datetime.utcnow()))
 
 def list_users() -> List[Dict]:
-    cur = _conn.cursor()
-    cur.execute("SELECT user_id, username, first_name, last_name, last_seen FROM users")
-    return [
-        {
-            "user_id": r[0],
-            "username": r[1],
-            "first_name": r[2],
-            "last_name": r[3],
-            "last_seen": r[4]
-        } for r in cur.fetchall()
-    ]
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, username, first_name, last_name, last_seen FROM users")
+        return [
+            {
+                "user_id": r[0],
+                "username": r[1],
+                "first_name": r[2],
+                "last_name": r[3],
+                "last_seen": r[4]
+            } for r in cur.fetchall()
+        ]
 
 def list_all_user_ids() -> list[int]:
-    cur = _conn.cursor()
-    cur.execute("SELECT user_id FROM users")
-    return [row[0] for row in cur.fetchall()]
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id FROM users")
+        return [row[0] for row in cur.fetchall()]
+
+def list_user_ids_after(after_id: int, limit: int) -> list[int]:
+    """One page of user ids in ascending order; keyset pagination on the primary key, so every page is an index seek."""
+    with reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_id, limit))
+        return [row[0] for row in cur.fetchall()]
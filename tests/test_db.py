@@ -0,0 +1,96 @@
+import importlib
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+import pytest
+from cryptography.fernet import Fernet
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    # db opens DB_PATH and reads MASTER_KEY at import time
+    mp = pytest.MonkeyPatch()
+    mp.setenv("DB_PATH", str(tmp_path_factory.mktemp("db") / "clones.db"))
+    mp.setenv("MASTER_KEY", Fernet.generate_key().decode())
+    mp.setenv("REFERRAL_THRESHOLD", "3")
+    yield importlib.import_module("db")
+    mp.undo()
+
+
+def hold_writer(db):
+    """Park the writer thread inside a write, so everything queued meanwhile lands in its next batch."""
+    entered, release = threading.Event(), threading.Event()
+
+    def block(cur):
+        entered.set()
+        release.wait(5)
+
+    db._write_queue.put(("SELECT 1", (), False, block, Future()))
+    assert entered.wait(5)
+    return release
+
+
+def queue_write(db, sql, params=()):
+    future = Future()
+    db._write_queue.put((sql, params, False, None, future))
+    return future
+
+
+def test_queued_writes_share_one_commit(db):
+    statements = []
+    db._conn.set_trace_callback(statements.append)
+    try:
+        release = hold_writer(db)
+        futures = [queue_write(db, db.UPSERT_USER_SQL, (uid, "", "", "", None)) for uid in (101, 102, 103)]
+        release.set()
+        for future in futures:
+            future.result(5)
+    finally:
+        db._conn.set_trace_callback(None)
+    # one transaction for the parked write, one for the three queued behind it
+    assert statements.count("BEGIN IMMEDIATE") == 2
+    assert {u["user_id"] for u in db.list_users()} >= {101, 102, 103}
+
+
+def test_failed_write_rolls_back_only_itself(db):
+    sql = "INSERT INTO referral_joins(user_id, referrer_id) VALUES (?, ?)"
+    release = hold_writer(db)
+    first = queue_write(db, sql, (201, 1))
+    duplicate = queue_write(db, sql, (201, 2))
+    last = queue_write(db, sql, (202, 1))
+    release.set()
+    first.result(5)
+    last.result(5)
+    with pytest.raises(sqlite3.IntegrityError):
+        duplicate.result(5)
+    with db.reader() as conn:
+        rows = conn.execute("SELECT user_id, referrer_id FROM referral_joins WHERE user_id IN (201, 202)").fetchall()
+    assert sorted(rows) == [(201, 1), (202, 1)]
+
+
+def test_increment_referral_verifies_at_threshold(db):
+    results = [db.increment_referral(301) for _ in range(db.REFERRAL_THRESHOLD + 1)]
+    assert [r["count"] for r in results] == list(range(1, db.REFERRAL_THRESHOLD + 2))
+    assert [r["verified"] for r in results] == [False] * (db.REFERRAL_THRESHOLD - 1) + [True, True]
+    assert db.get_referral(301)["verified"]
+
+
+def test_token_unique_among_active_clones_only(db):
+    db.save_clone(401, "401:token-a", "bot_a", "be brief")
+    with pytest.raises(sqlite3.IntegrityError):
+        db.save_clone(402, "401:token-a", "bot_a", "be brief")
+    # a retired clone's token can be cloned again
+    db.deactivate_clone(401)
+    db.save_clone(402, "401:token-a", "bot_a", "be brief")
+    assert db.get_clone_by_token("401:token-a")["user_id"] == 402
+
+
+def test_duplicate_token_rolls_back_whole_save_clones_batch(db):
+    with pytest.raises(sqlite3.IntegrityError):
+        db.save_clones([
+            (501, "501:token-b", "bot_b", "", "owner_a"),
+            (502, "501:token-b", "bot_b", "", "owner_b"),
+        ])
+    assert db.get_clone(501) is None
+    assert db.get_clone(502) is None